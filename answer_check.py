@@ -0,0 +1,64 @@
+"""Local answer check: grades plain numeric answers without calling Gemini.
+
+Kept apart from app.py so it can be tested without running the Streamlit script.
+"""
+from fractions import Fraction
+import re
+
+# Units the local check understands; any other trailing letters (e.g. "5n" in
+# algebra) make the answer non-numeric and send it to the judge
+ANSWER_UNITS = (
+    r"%|°|(?:mm|cm|km|m)(?:\^?[23²³])?|mg|kg|g|ml|l|ha|p"
+    r"|pounds?|pence|metres?|meters?|centimetres?|millimetres?|kilometres?"
+    r"|grams?|kilograms?|litres?|liters?|hectares?|degrees?|hours?|minutes?|seconds?|days?"
+)
+
+# Units that can't be read as an algebra variable, so "25" may still match "25%"
+SYMBOL_UNITS = ("%", "°", "£", "$", "€")
+
+# Matches answers like "£12.50", "-3/4", "1,200", "25%", "x = 7" or "45 cm2"
+NUMERIC_ANSWER = re.compile(
+    r"^(?:([a-z])\s*=\s*)?([£$€])?\s*(-?(?:\d{1,3}(?:,\d{3})+|\d+)?(?:\.\d+)?(?:/\d+)?)\s*("
+    + ANSWER_UNITS
+    + r")?\.?$"
+)
+
+def parse_number(text):
+    """Splits a numeric answer into (value, unit, variable); returns None if it isn't one."""
+    match = NUMERIC_ANSWER.match(text)
+    if not match:
+        return None
+    variable, symbol, number, unit = match.groups()
+    try:
+        value = Fraction(number.replace(",", ""))
+    except (ValueError, ZeroDivisionError):
+        return None
+    if unit:
+        unit = unit.replace("^", "").replace("²", "2").replace("³", "3")
+    return value, symbol or unit or "", variable or ""
+
+def check_answer_locally(user_ans, correct_ans):
+    """Returns True/False when the answers can be compared without Gemini, or None if unsure."""
+    user = user_ans.strip().lower()
+    correct = correct_ans.strip().lower()
+    if user == correct:
+        return True
+
+    user_parsed, correct_parsed = parse_number(user), parse_number(correct)
+    if user_parsed is None or correct_parsed is None:
+        return None
+    (user_num, user_unit, user_var), (correct_num, correct_unit, correct_var) = user_parsed, correct_parsed
+    if user_var != correct_var:
+        # "y = 7" vs "x = 7", or "7" vs "x = 7": let the judge decide
+        return None
+    if user_unit != correct_unit:
+        if user_unit and correct_unit:
+            # e.g. "50 mm" vs "5 cm": leave unit conversions to the judge
+            return None
+        if (user_unit or correct_unit) not in SYMBOL_UNITS:
+            # "5" vs "5p" may be pence or the algebra term 5p: let the judge decide
+            return None
+    if abs(user_num - correct_num) < Fraction(1, 10**6):
+        return True
+    # Plain numbers that differ are wrong; with a unit involved (0.25 vs 25%) ask the judge
+    return False if not (user_unit or correct_unit) else None
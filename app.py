@@ -1,19 +1,33 @@
 import streamlit as st
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from google.api_core import retry as google_retry
 import os
 import pandas as pd
 import gspread
 from datetime import datetime
+import random
+import atexit
+import enum
+import json
 import threading  # NEW: For background saving
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from answer_check import check_answer_locally
 
 # --- CONFIGURATION & SETUP ---
 
 # 1. API Key Setup
+@st.cache_resource
+def configure_gemini(api_key):
+    """Runs genai.configure once per process instead of on every rerun."""
+    genai.configure(api_key=api_key)
+
 try:
     if "GEMINI_API_KEY" in st.secrets:
-        genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
+        configure_gemini(st.secrets["GEMINI_API_KEY"])
     elif "GEMINI_API_KEY" in os.environ:
-        genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+        configure_gemini(os.environ["GEMINI_API_KEY"])
     else:
         st.error("Missing GEMINI_API_KEY! Please check your secrets.toml.")
         st.stop()
@@ -22,41 +36,179 @@ except Exception as e:
     st.stop()
 
 # 2. Optimized Google Sheets Connection
+def normalize_service_account(raw_creds):
+    """Copies the service-account secrets, un-escaping the private key only if needed."""
+    creds_dict = dict(raw_creds)
+    private_key = creds_dict.get("private_key", "")
+    if "\\n" in private_key:
+        creds_dict["private_key"] = private_key.replace("\\n", "\n")
+    return creds_dict
+
 @st.cache_resource
 def get_google_sheet_client():
     try:
         if "gcp_service_account" not in st.secrets:
             return None
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        if "private_key" in creds_dict:
-            creds_dict["private_key"] = creds_dict["private_key"].replace("\\n", "\n")
+        creds_dict = normalize_service_account(st.secrets["gcp_service_account"])
         client = gspread.service_account_from_dict(creds_dict)
         return client
     except Exception:
         return None
 
-def save_to_google_sheet_background(data_row):
-    """Runs in a separate thread to avoid freezing the app."""
+@st.cache_resource
+def get_history_sheet():
+    """Opens the history worksheet once per process instead of on every save."""
+    client = get_google_sheet_client()
+    if client is None:
+        return None
+    # Opening by key is a direct lookup; opening by name needs a Drive search
+    if "SHEET_ID" in st.secrets:
+        return client.open_by_key(st.secrets["SHEET_ID"]).sheet1
+    sheet_name = st.secrets.get("SHEET_NAME", "Math Practice History")
+    return client.open(sheet_name).sheet1
+
+# Rows are held briefly so answers arriving close together share one append request
+SAVE_BATCH_SIZE = 5
+SAVE_BATCH_WAIT = 2  # seconds
+
+def write_history_rows(rows):
     try:
-        client = get_google_sheet_client()
-        if client:
-            sheet_name = st.secrets.get("SHEET_NAME", "Math Practice History")
-            sheet = client.open(sheet_name).sheet1
-            sheet.append_row(data_row)
+        sheet = get_history_sheet()
+        if sheet:
+            sheet.append_rows(rows, value_input_option="RAW", insert_data_option="INSERT_ROWS")
     except Exception as e:
         print(f"Background save failed: {e}")
 
+def save_to_google_sheet_background(save_queue):
+    """Long-lived writer thread: collects queued rows and writes each batch in one request."""
+    stopping = False
+    while not stopping:
+        rows = []
+        row = save_queue.get()
+        while row is not None:
+            rows.append(row)
+            if len(rows) >= SAVE_BATCH_SIZE:
+                break
+            try:
+                row = save_queue.get(timeout=SAVE_BATCH_WAIT)
+            except queue.Empty:
+                break
+        stopping = row is None
+        if rows:
+            write_history_rows(rows)
+
+def stop_background_saves(save_queue, worker):
+    """Flushes rows still waiting in the writer when the server shuts down."""
+    save_queue.put(None)
+    worker.join(timeout=10)
+
+@st.cache_resource
+def get_save_queue():
+    """Starts one writer thread per process and returns the queue that feeds it."""
+    save_queue = queue.Queue()
+    worker = threading.Thread(target=save_to_google_sheet_background, args=(save_queue,), daemon=True)
+    worker.start()
+    atexit.register(stop_background_saves, save_queue, worker)
+    return save_queue
+
 def trigger_background_save(data_row):
-    """Starts the save process without making the user wait."""
-    thread = threading.Thread(target=save_to_google_sheet_background, args=(data_row,))
-    thread.start()
+    """Queues the row for the writer thread without making the user wait."""
+    get_save_queue().put(data_row)
+
+# 3. Cached Gemini Models
+# The judge only ever replies with one word, so it runs on the non-thinking
+# Flash-Lite model with a tiny, deterministic output budget. (Gemini 2.5 Flash
+# spends its thinking tokens out of max_output_tokens, which the installed SDK
+# cannot switch off.)
+JUDGE_MODEL_NAME = "models/gemini-2.5-flash-lite"
+JUDGE_INSTRUCTIONS = (
+    "You grade maths answers. Q is the question, A the correct answer and S the student's answer. "
+    "Reply CORRECT if S is the same answer as A, ignoring formatting (e.g. £10 vs 10 pounds, 0.5 vs 1/2), "
+    "otherwise INCORRECT."
+)
+
+class Verdict(enum.Enum):
+    CORRECT = "CORRECT"
+    INCORRECT = "INCORRECT"
+
+# Constrained decoding: the reply can only be one of the Verdict values, nothing else
+JUDGE_CONFIG = genai.types.GenerationConfig(
+    response_mime_type="text/x.enum",
+    response_schema=Verdict,
+    max_output_tokens=4,
+    temperature=0,
+)
+
+QUESTION_MODEL_NAME = "models/gemini-2.5-flash"
+
+# Fixed rules live on the model; each request only sends what changes per tier
+QUESTION_INSTRUCTIONS = """Act as a GCSE Maths teacher creating worksheet questions similar to CorbettMaths style.
+
+Requirements:
+1. Each question must be clear and direct.
+2. If it is a word problem, use British English (e.g., £ for currency, metres for distance).
+3. Ensure the numbers are clean enough to be solved without a calculator if appropriate for the topic.
+4. The questions must be on tougher side.
+5. The sample questions can be taken from www.corbettmaths.com
+6. For each question, "answer" is the Final Numerical Answer or Short Phrase only:
+   no working, no full sentence, e.g. "£12.50", "3/4", "x = 7" or "45 cm2"."""
+
+# Question sets come back as schema-checked JSON, so no delimiter parsing is needed
+QUESTION_SET_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {"question": {"type": "string"}, "answer": {"type": "string"}},
+        "required": ["question", "answer"],
+    },
+}
+QUESTION_SET_CONFIG = genai.types.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=QUESTION_SET_SCHEMA,
+)
+
+# Back off and retry when Gemini is throttling or overloaded, and give up on stuck
+# requests instead of hanging the app. The prefetch pool caps background calls at two.
+GEMINI_RETRY = google_retry.Retry(
+    predicate=google_retry.if_exception_type(
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+    ),
+    initial=0.5,
+    maximum=8,
+    multiplier=2,
+    timeout=120,
+)
+QUESTION_REQUEST_OPTIONS = {"retry": GEMINI_RETRY, "timeout": 90}
+JUDGE_REQUEST_OPTIONS = {"retry": GEMINI_RETRY.with_timeout(30), "timeout": 15}
+
+@st.cache_resource
+def get_gemini_model(name=QUESTION_MODEL_NAME, system_instruction=None):
+    """Builds each Gemini model once per process and shares it across reruns."""
+    return genai.GenerativeModel(name, system_instruction=system_instruction)
+
+# 4. Shared Worker Pool for Prefetching Questions
+@st.cache_resource
+def get_prefetch_executor():
+    return ThreadPoolExecutor(max_workers=2)
 
 # --- LOGIC FUNCTIONS ---
 
+# Questions are generated one tier at a time: (difficulty, first Q#, last Q#)
+DIFFICULTY_TIERS = (
+    ("Easy (Foundation)", 1, 7),
+    ("Medium (Crossover)", 8, 15),
+    ("Hard (Higher)", 16, 25),
+)
+
+def get_difficulty_tier(q_number):
+    for tier in DIFFICULTY_TIERS:
+        if q_number <= tier[2]: return tier
+    return DIFFICULTY_TIERS[-1]
+
 def get_current_difficulty(q_number):
-    if q_number <= 7: return "Easy (Foundation)"
-    elif q_number <= 15: return "Medium (Crossover)"
-    else: return "Hard (Higher)"
+    return get_difficulty_tier(q_number)[0]
 
 def get_curriculum_context(topic):
     """Maps the high-level topic to specific GCSE sub-skills."""
@@ -72,59 +224,126 @@ def get_curriculum_context(topic):
     }
     return curriculum_map.get(topic, "GCSE Maths curriculum")
 
-def get_new_question():
-    model = genai.GenerativeModel("models/gemini-2.5-flash")
-    
-    if st.session_state.question_count > 25:
-        st.session_state.question_text = "🎉 You have completed all 25 questions! Great job."
-        st.session_state.is_finished = True
-        return
+# Each session draws one of this many cached question sets, so students sharing
+# a grade and topic don't all see the same 25 questions. The pool is tagged with
+# the ISO week, so the disk cache (which Streamlit never expires) is refilled
+# with fresh sets each week instead of serving the same five forever.
+QUESTION_VARIANTS = 5
 
-    topic = st.session_state.opt_topic
-    grade = st.session_state.opt_grade
-    difficulty = get_current_difficulty(st.session_state.question_count)
-    sub_topic_context = get_curriculum_context(topic)
+def pick_question_variant():
+    """Picks one of this week's cached question sets for a new session."""
+    year, week, _ = datetime.now().isocalendar()
+    return f"{year}-W{week:02d}/{random.randrange(QUESTION_VARIANTS)}"
+
+@st.cache_data(persist="disk", show_spinner=False)
+def generate_question_set(grade, topic, difficulty, first, last, variant, sub_topic_context, model_name, instructions, config):
+    """Calls Gemini once for a whole difficulty tier and returns its (question, answer) pairs.
+
+    Safe to run off the main thread. Everything that shapes the reply is an
+    argument, so it is all part of the disk cache key and a tier is only
+    generated again when one of them changes.
+    """
+    count = last - first + 1
     
     prompt = f"""
-    Act as a GCSE Maths teacher creating a worksheet question similar to CorbettMaths style.
-    
     Target Student: {grade}
     Topic: {topic}
     Specific Skills to Test: {sub_topic_context}
-    Difficulty: {difficulty} (Question {st.session_state.question_count} of 25)
+    Difficulty: {difficulty} (Questions {first} to {last} of 25)
+    Write exactly {count} different questions, getting gradually harder.
+    """
     
-    Requirements:
-    1. The question must be clear and direct.
-    2. If it is a word problem, use British English (e.g., £ for currency, metres for distance).
-    3. Ensure the numbers are clean enough to be solved without a calculator if appropriate for the topic.
-    4. The question must be on tougher side.
-    5. The sample questions can be taken from www.corbettmaths.com
+    model = get_gemini_model(model_name, instructions)
+    response = model.generate_content(
+        prompt, generation_config=config, request_options=QUESTION_REQUEST_OPTIONS
+    )
+    items = json.loads(response.text)
     
-    Output exactly in this format:
-    [The Question Text]
-    |||
-    [The Final Numerical Answer or Short Phrase]
-    """
+    if len(items) < count:
+        # Raise rather than return, so a short reply is never written to the cache
+        raise ValueError(f"Gemini returned {len(items)} of {count} questions.")
+    return [(item["question"].strip(), item["answer"].strip()) for item in items[:count]]
+
+def question_set_key(q_number):
+    """The generate_question_set arguments for the tier containing question q_number."""
+    difficulty, first, last = get_difficulty_tier(q_number)
+    topic = st.session_state.opt_topic
+    return (
+        st.session_state.opt_grade,
+        topic,
+        difficulty,
+        first,
+        last,
+        st.session_state.question_variant,
+        get_curriculum_context(topic),
+        QUESTION_MODEL_NAME,
+        QUESTION_INSTRUCTIONS,
+        QUESTION_SET_CONFIG,
+    )
+
+def prefetch_next_question_set():
+    """Starts generating the next difficulty tier in the background while the student works."""
+    last = get_difficulty_tier(st.session_state.question_count)[2]
+    if last >= 25:
+        return
+    key = question_set_key(last + 1)
+    if st.session_state.get("prefetch_key") == key:
+        return
+    
+    stale = st.session_state.get("prefetch_future")
+    if stale is not None:
+        # Grade/topic changed or the session restarted: drop the stale request
+        stale.cancel()
+    st.session_state.prefetch_key = key
+    st.session_state.prefetch_future = get_prefetch_executor().submit(generate_question_set, *key)
+
+def take_prefetched_question_set(key):
+    """Returns the prefetched question set for key, or None on a miss."""
+    if st.session_state.get("prefetch_key") != key:
+        return None
+    future = st.session_state.pop("prefetch_future")
+    del st.session_state["prefetch_key"]
+    try:
+        return future.result()
+    except Exception:
+        return None
+
+def get_new_question():
+    if st.session_state.question_count > 25:
+        st.session_state.question_text = "🎉 You have completed all 25 questions! Great job."
+        st.session_state.is_finished = True
+        return
+
+    key = question_set_key(st.session_state.question_count)
+    shown_key = (key, st.session_state.question_count)
+    if st.session_state.get("shown_key") == shown_key:
+        # Settings re-applied unchanged: keep the current question and the student's progress on it
+        return
     
     try:
-        response = model.generate_content(prompt)
-        text = response.text
+        question_set = take_prefetched_question_set(key)
+        # Queue the next tier first so it generates alongside any synchronous call below
+        prefetch_next_question_set()
+        if question_set is None:
+            question_set = generate_question_set(*key)
         
-        if "|||" in text:
-            q, a = text.split("|||")
-            st.session_state.question_text = q.strip()
-            st.session_state.answer_text = a.strip()
-        else:
-            st.session_state.question_text = text
-            st.session_state.answer_text = "Error parsing answer."
-            
+        q, a = question_set[st.session_state.question_count - key[3]]
+        st.session_state.question_text = q
+        st.session_state.answer_text = a
         st.session_state.reveal_answer = False
         st.session_state.feedback = "" 
         st.session_state.user_input = "" 
+        st.session_state.shown_key = shown_key
+        # A newly shown question can be logged again, even if the cache served it before
+        st.session_state.last_logged = ""
             
     except Exception as e:
         st.error(f"Error generating question: {e}")
 
+def new_history_df():
+    """Empty session history table; rows are appended in place as answers come in."""
+    return pd.DataFrame(columns=["Q#", "Topic", "Difficulty", "Result"])
+
 def check_answer():
     user_ans = st.session_state.user_input
     correct_ans = st.session_state.answer_text
@@ -134,24 +353,17 @@ def check_answer():
         st.session_state.feedback = "Please enter an answer first."
         return
 
-    # Quick local check for exact matches to speed up simple answers
-    if user_ans.strip() == correct_ans.strip():
-        is_correct = True
-    else:
-        # Fallback to AI Judge for varied formats (e.g. 1/2 vs 0.5)
+    # Quick local check for exact and numeric matches to skip the AI judge
+    is_correct = check_answer_locally(user_ans, correct_ans)
+    if is_correct is None:
+        # Fallback to AI Judge for varied formats (e.g. £10 vs 10 pounds)
         try:
-            judge_model = genai.GenerativeModel("models/gemini-2.5-flash")
-            judge_prompt = f"""
-            Question: {question}
-            Correct Answer: {correct_ans}
-            Student Answer: {user_ans}
-            
-            Compare the Student Answer to the Correct Answer.
-            Ignore minor formatting differences (e.g. £10 vs 10 pounds, 0.5 vs 1/2).
-            Reply with ONLY one word: "CORRECT" or "INCORRECT".
-            """
-            response = judge_model.generate_content(judge_prompt)
-            is_correct = "CORRECT" in response.text.strip().upper()
+            judge_model = get_gemini_model(JUDGE_MODEL_NAME, JUDGE_INSTRUCTIONS)
+            judge_prompt = f"Q: {question[:200]}\nA: {correct_ans}\nS: {user_ans}"
+            response = judge_model.generate_content(
+                judge_prompt, generation_config=JUDGE_CONFIG, request_options=JUDGE_REQUEST_OPTIONS
+            )
+            is_correct = response.text.strip() == Verdict.CORRECT.value
         except:
             is_correct = False
 
@@ -162,19 +374,21 @@ def check_answer():
         st.session_state.feedback = f"❌ Incorrect. The answer was: {correct_ans}"
     
     # Save Logic
-    current_q_signature = f"{st.session_state.question_count}-{question[:10]}"
+    # Grade, topic, variant and Q#: cached questions repeat, so question text can't tell them apart
+    current_q_signature = st.session_state.get("shown_key")
     
     if st.session_state.last_logged != current_q_signature:
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         status = "Correct" if is_correct else "Incorrect"
         difficulty = get_current_difficulty(st.session_state.question_count)
         
-        st.session_state.history_list.append({
-            "Q#": st.session_state.question_count,
-            "Topic": st.session_state.opt_topic,
-            "Difficulty": difficulty,
-            "Result": status
-        })
+        history = st.session_state.history_df
+        history.loc[len(history)] = [
+            st.session_state.question_count,
+            st.session_state.opt_topic,
+            difficulty,
+            status
+        ]
         
         row_data = [
             timestamp,
@@ -197,22 +411,38 @@ def next_question_handler():
     st.session_state.question_count += 1
     get_new_question()
 
+def restart_session_handler():
+    st.session_state.score_correct = 0
+    st.session_state.question_count = 1
+    st.session_state.question_variant = pick_question_variant()
+    st.session_state.history_df = new_history_df()
+    st.session_state.is_finished = False
+    st.session_state.shown_key = None
+    st.session_state.last_logged = ""
+    get_new_question()
+
 # --- INITIALIZATION ---
+SESSION_DEFAULTS = {
+    "question_text": "",
+    "answer_text": "",
+    "user_input": "",
+    "feedback": "",
+    "reveal_answer": False,
+    "is_finished": False,
+    "score_correct": 0,
+    "question_count": 1,
+    "last_logged": "",
+    "question_variant": pick_question_variant(),
+    "opt_grade": "Year 6 (KS3)",
+    "opt_topic": "Place Value & Rounding",
+}
+for key, value in SESSION_DEFAULTS.items():
+    st.session_state.setdefault(key, value)
+
 if 'init' not in st.session_state:
     st.session_state.init = True
-    st.session_state.question_text = ""
-    st.session_state.user_input = ""
-    st.session_state.feedback = ""
-    st.session_state.is_finished = False
-    st.session_state.score_correct = 0
-    st.session_state.question_count = 1 
-    st.session_state.history_list = []
-    st.session_state.last_logged = ""
-    
-    if "GEMINI_API_KEY" in st.secrets or "GEMINI_API_KEY" in os.environ:
-        st.session_state.opt_grade = "Year 6 (KS3)" 
-        st.session_state.opt_topic = "Place Value & Rounding" 
-        get_new_question()
+    st.session_state.history_df = new_history_df()
+    get_new_question()
 
 # --- SIDEBAR ---
 with st.sidebar:
@@ -227,29 +457,26 @@ with st.sidebar:
     st.divider()
     st.header("Settings")
     
-    # Updated Grade Levels to UK System
-    st.selectbox("Select Year Group", ["Year 6 (KS3)", "Year 7 (KS3)", "Year 8 (KS3)", "Year 9 (KS3)", "Year 10 (GCSE)", "Year 11 (GCSE)"], key="opt_grade", on_change=get_new_question)
-    
-    # Updated Topics based on your Feedback
-    topics_list = [
-        "Algebra",
-        "Place Value & Rounding",
-        "Decimals",
-        "Angles & Construction",
-        "Collecting Data",
-        "Fractions",
-        "Shapes & Areas",
-        "Percentages"
-    ]
-    st.selectbox("Select Topic", topics_list, key="opt_topic", on_change=get_new_question)
+    # Grouped in a form so changing both dropdowns costs one question fetch, on Apply
+    with st.form("settings_form"):
+        # Updated Grade Levels to UK System
+        st.selectbox("Select Year Group", ["Year 6 (KS3)", "Year 7 (KS3)", "Year 8 (KS3)", "Year 9 (KS3)", "Year 10 (GCSE)", "Year 11 (GCSE)"], key="opt_grade")
+        
+        # Updated Topics based on your Feedback
+        topics_list = [
+            "Algebra",
+            "Place Value & Rounding",
+            "Decimals",
+            "Angles & Construction",
+            "Collecting Data",
+            "Fractions",
+            "Shapes & Areas",
+            "Percentages"
+        ]
+        st.selectbox("Select Topic", topics_list, key="opt_topic")
+        st.form_submit_button("Apply Settings", on_click=get_new_question)
     
-    if st.button("Restart Session"):
-        st.session_state.score_correct = 0
-        st.session_state.question_count = 1
-        st.session_state.history_list = []
-        st.session_state.is_finished = False
-        get_new_question()
-        st.rerun()
+    st.button("Restart Session", on_click=restart_session_handler)
 
 # --- MAIN UI ---
 st.title(f"🎓 {st.session_state.user_name_input}'s GCSE Maths Prep")
@@ -262,14 +489,12 @@ if not st.session_state.is_finished:
     st.info(st.session_state.question_text)
 
     st.markdown("### Your Answer")
-    st.text_input("Type your answer here:", key="user_input")
+    # In a form so the app reruns once on Submit, not whenever the answer box changes
+    with st.form("answer_form"):
+        st.text_input("Type your answer here:", key="user_input")
+        st.form_submit_button("Submit Answer", on_click=check_answer)
 
-    col1, col2 = st.columns([1, 1])
-    
-    with col1: 
-        st.button("Submit Answer", on_click=check_answer)
-    with col2: 
-        st.button("Next Question", on_click=next_question_handler)
+    st.button("Next Question", on_click=next_question_handler)
 
     if st.session_state.feedback:
         if "Correct!" in st.session_state.feedback:
@@ -287,8 +512,7 @@ else:
     st.balloons()
     st.write(f"Final Score: {st.session_state.score_correct} / 25")
 
-if st.session_state.history_list:
+if not st.session_state.history_df.empty:
     st.markdown("---")
     st.markdown("### 📜 Session History")
-    df = pd.DataFrame(st.session_state.history_list)
-    st.dataframe(df, use_container_width=True)
+    st.dataframe(st.session_state.history_df, use_container_width=True)
@@ -0,0 +1,56 @@
+import pytest
+
+from answer_check import check_answer_locally, parse_number
+
+
+@pytest.mark.parametrize("user, correct", [
+    ("0.5", "1/2"),
+    ("1200", "1,200"),
+    ("£12.50", "12.5"),
+    ("25", "25%"),
+    ("45", "45°"),
+    ("45 cm^2", "45cm2"),
+    ("x=7", "x = 7"),
+    ("3 kg", "3kg"),
+])
+def test_equivalent_answers_are_correct(user, correct):
+    assert check_answer_locally(user, correct) is True
+
+
+@pytest.mark.parametrize("user, correct", [
+    ("3", "4"),
+    ("-3/4", "3/4"),
+    ("x = 6", "x = 7"),
+])
+def test_different_plain_numbers_are_incorrect(user, correct):
+    assert check_answer_locally(user, correct) is False
+
+
+@pytest.mark.parametrize("user, correct", [
+    # Algebra terms and variables
+    ("5", "5n"),
+    ("3x", "3"),
+    ("y = 7", "x = 7"),
+    ("7", "x = 7"),
+    # Single-letter units that are also common variables, on one side only
+    ("5", "5p"),
+    ("5p", "5"),
+    ("5m", "5"),
+    ("4g", "4"),
+    ("2", "2l"),
+    # Unit conversions and unit answers that differ
+    ("50 mm", "5 cm"),
+    ("0.25", "25%"),
+    ("3 kg", "4 kg"),
+    # Not numeric at all
+    ("ten", "10"),
+])
+def test_unsure_answers_go_to_the_judge(user, correct):
+    assert check_answer_locally(user, correct) is None
+
+
+def test_parse_number_splits_value_unit_and_variable():
+    assert parse_number("x = -3/4") == (pytest.approx(-0.75), "", "x")
+    assert parse_number("£1,250.50") == (pytest.approx(1250.5), "£", "")
+    assert parse_number("45 cm²") == (45, "cm2", "")
+    assert parse_number("5n") is None